@@ -2,17 +2,38 @@ import os
 import re
 import tempfile
 import traceback
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache, partial
 from flask import Flask, render_template, request, send_file, jsonify
 from werkzeug.utils import secure_filename
+import numpy as np
 import pandas as pd
 from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, NamedStyle, PatternFill, Alignment, Border, Side
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 import fitz  # PyMuPDF
 import pytesseract
 from PIL import Image
-import io
+
+try:
+    import ahocorasick
+except ImportError:  # optional, categorization falls back to regex only
+    ahocorasick = None
+
+try:
+    import re2
+except ImportError:  # optional, category regexes fall back to stdlib re
+    re2 = None
+
+try:
+    import cv2
+except ImportError:  # optional, OCR pages are not binarized
+    cv2 = None
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max
@@ -20,6 +41,15 @@ app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
 
 ALLOWED_EXTENSIONS = {'pdf', 'xls', 'xlsx', 'csv'}
 
+# Render scale for OCR; binarized pages read as well at 2x as plain grayscale at 3x
+OCR_DPI_SCALE = 2 if cv2 is not None else 3
+
+# Ceiling on OCR worker processes per upload; each holds a PyMuPDF document and a rendered page
+OCR_WORKERS = max(1, int(os.environ.get('OCR_WORKERS', 2)))
+
+# OCR with custom config for better table recognition
+OCR_CONFIG = r'--oem 3 --psm 6'
+
 # Transaction categorization patterns for SBI statements
 CATEGORY_PATTERNS = {
     # Deposits - ordered from most specific to least specific
@@ -47,33 +77,266 @@ CATEGORY_PATTERNS = {
 }
 
 
+REGEX_METACHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def _compile_category_patterns(category_patterns):
+    """Split each category's patterns into upper-cased literals and one fused regex"""
+    compiled = []
+    for category, patterns in category_patterns.items():
+        literals = []
+        regexes = []
+        for pattern in patterns:
+            pattern = pattern.removeprefix('(?i)')
+            if REGEX_METACHARS.isdisjoint(pattern):
+                literals.append(pattern.upper())
+            else:
+                regexes.append(f'(?:{pattern})')
+        regex = re.compile('|'.join(regexes), re.IGNORECASE) if regexes else None
+        compiled.append((category, literals, regex))
+    return compiled
+
+
+CATEGORY_TIERS = _compile_category_patterns(CATEGORY_PATTERNS)
+
+# Non-ASCII (or control-character) descriptions bypass the literal/RE2 fast paths
+STDLIB_ONLY_CHARS_RE = re.compile(r'[^\t -~]')
+CATEGORY_REGEXES = [
+    (category, re.compile('|'.join(f'(?:{pattern.removeprefix("(?i)")})' for pattern in patterns),
+                          re.IGNORECASE))
+    for category, patterns in CATEGORY_PATTERNS.items()
+]
+
+# Categories with literal patterns, checked with `in` when there is no automaton
+LITERAL_TIERS = [(priority, category, literals)
+                 for priority, (category, literals, _) in enumerate(CATEGORY_TIERS) if literals]
+
+
+def _build_literal_automaton(category_tiers):
+    """Index the literal patterns in an Aho-Corasick automaton, mapped to (priority, category)"""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for priority, (category, literals, _) in enumerate(category_tiers):
+        for literal in literals:
+            if literal not in automaton:
+                automaton.add_word(literal, (priority, category))
+    automaton.make_automaton()
+    return automaton
+
+
+LITERAL_AUTOMATON = _build_literal_automaton(CATEGORY_TIERS)
+
+
+def _build_category_set(category_tiers):
+    """Load the fused category regexes into one RE2 set"""
+    if re2 is None:
+        return None, []
+    options = re2.Options()
+    options.log_errors = False
+    category_set = re2.Set.SearchSet(options)
+    priorities = []
+    for priority, (category, _, regex) in enumerate(category_tiers):
+        if regex is None:
+            continue
+        try:
+            category_set.Add('(?i)' + regex.pattern)
+        except re2.error:
+            continue
+        priorities.append(priority)
+    if not priorities:
+        return None, []
+    category_set.Compile()
+    return category_set, priorities
+
+
+CATEGORY_SET, CATEGORY_SET_PRIORITIES = _build_category_set(CATEGORY_TIERS)
+
+# Category regexes not covered by the RE2 set are searched one by one
+STDLIB_CATEGORY_REGEXES = [(priority, category, regex)
+                           for priority, (category, _, regex) in enumerate(CATEGORY_TIERS)
+                           if regex is not None and priority not in CATEGORY_SET_PRIORITIES]
+
+# Withdrawal keywords, matched as plain substrings in a single pass ('DR$' included)
+WITHDRAWAL_KEYWORDS_RE = re.compile('|'.join(map(re.escape, [
+    'WDL', 'WITHDRAWAL', 'TO INTEREST', 'DIRECT DR', 'DEBIT', 'LEVY', 'DR$', 'ATM'])))
+INFERRED_WITHDRAWAL_RE = re.compile('|'.join(map(re.escape, [
+    'WDL', 'WITHDRAWAL', 'DEBIT', 'DR', 'TRANSFER OUT'])))
+
+# Account header patterns, compiled once
+ACCOUNT_NO_RE = re.compile(r'Account\s*(?:No|Number)[:\s]+(\d+)', re.IGNORECASE)
+ACCOUNT_NAME_RE = re.compile(r'(?:Mr\.|Mrs\.|Ms\.?)\s*([A-Z\s]+?)(?:\n|#|Address)', re.IGNORECASE)
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def extract_text_from_image_pdf(pdf_path, dpi_scale=3):
-    """Extract text from image-based PDF using OCR with higher quality"""
-    doc = fitz.open(pdf_path)
-    all_text = []
-    
-    for page_num in range(len(doc)):
-        page = doc[page_num]
+def _init_ocr_worker():
+    """Keep tesseract single-threaded so parallel pages don't oversubscribe the CPU"""
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+def _ocr_image(image_path, page_num):
+    """OCR a single rendered page image"""
+    try:
+        return pytesseract.image_to_string(image_path, lang='eng', config=OCR_CONFIG)
+    except Exception as e:
+        print(f"OCR failed for page {page_num}: {e}")
+        return None
+
+
+def _render_page(doc, page_num, dpi_scale):
+    """Render a page to a grayscale image for OCR, binarized when OpenCV is available"""
+    # Grayscale since tesseract ignores colour
+    pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(dpi_scale, dpi_scale),
+                                   colorspace=fitz.csGRAY, alpha=False)
+    width, height, samples = pix.width, pix.height, pix.samples
+    pix = None  # samples is a copy, so the pixmap's own buffer can go now
+    if cv2 is None:
+        return Image.frombuffer('L', (width, height), samples, 'raw', 'L', 0, 1)
+    
+    # Adaptive threshold evens out scan shading and keeps text crisp at lower DPI
+    gray = np.frombuffer(samples, dtype=np.uint8).reshape(height, width)
+    bw = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)
+    return Image.fromarray(bw)
+
+
+def _rendered_pages(doc, page_nums, dpi_scale):
+    """Yield (page_num, image) per page, freeing each page's pixels before the next is rendered"""
+    for page_num in page_nums:
+        img = _render_page(doc, page_num, dpi_scale)
+        try:
+            yield page_num, img
+        finally:
+            img.close()
+
+
+def _ocr_pages_with_api(pdf_path, page_nums, dpi_scale, tesserocr):
+    """OCR a batch of pages through one in-process tesseract instance"""
+    texts = []
+    with tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK, oem=tesserocr.OEM.DEFAULT, lang='eng') as api, \
+            fitz.open(pdf_path) as doc:
+        for page_num, img in _rendered_pages(doc, page_nums, dpi_scale):
+            try:
+                api.SetImage(img)
+                texts.append(api.GetUTF8Text())
+            except Exception as e:
+                print(f"OCR failed for page {page_num}: {e}")
+                texts.append(None)
+            finally:
+                api.Clear()
+    return texts
+
+
+def _ocr_pages_with_cli(pdf_path, page_nums, dpi_scale):
+    """OCR a batch of rendered pages with one tesseract filelist call, page by page if that fails"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        image_paths = []
+        with fitz.open(pdf_path) as doc:
+            for page_num, img in _rendered_pages(doc, page_nums, dpi_scale):
+                # Uncompressed PGM: tesseract reads raw pixels, no PNG deflate/inflate
+                image_path = os.path.join(tmpdir, f'page_{page_num + 1:04d}.pgm')
+                img.save(image_path)
+                image_paths.append(image_path)
         
-        # Higher resolution for better OCR
-        pix = page.get_pixmap(matrix=fitz.Matrix(dpi_scale, dpi_scale))
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
+        filelist_path = os.path.join(tmpdir, 'filelist.txt')
+        with open(filelist_path, 'w') as f:
+            f.write('\n'.join(image_paths) + '\n')
         
-        # OCR with custom config for better table recognition
-        custom_config = r'--oem 3 --psm 6'
         try:
-            text = pytesseract.image_to_string(img, lang='eng', config=custom_config)
-            all_text.append(text)
+            text = pytesseract.image_to_string(filelist_path, lang='eng', config=OCR_CONFIG)
+            texts = text.split('\x0c')
+            if len(texts) >= len(page_nums):
+                return texts[:len(page_nums)]
+            print(f"Batch OCR returned {len(texts)} pages, expected {len(page_nums)}")
         except Exception as e:
-            print(f"OCR failed for page {page_num}: {e}")
+            print(f"Batch OCR failed for pages {list(page_nums)}: {e}")
+        
+        return [_ocr_image(image_path, page_num) for image_path, page_num in zip(image_paths, page_nums)]
+
+
+def _ocr_pages(pdf_path, page_nums, dpi_scale=OCR_DPI_SCALE):
+    """OCR a batch of pages in a worker, via tesserocr when installed, else the tesseract CLI"""
+    try:
+        import tesserocr
+        return _ocr_pages_with_api(pdf_path, page_nums, dpi_scale, tesserocr)
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"tesserocr failed, falling back to tesseract CLI: {e}")
+    return _ocr_pages_with_cli(pdf_path, page_nums, dpi_scale)
+
+
+def _available_cpus():
+    """CPUs this process may run on; os.cpu_count() reports every core on the host"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def ocr_pdf_pages(pdf_path, page_nums, dpi_scale=OCR_DPI_SCALE):
+    """OCR the given pages, one batch of pages per worker process; returns a text (or None) per page"""
+    page_nums = list(page_nums)
+    if not page_nums:
+        return []
+    
+    workers = min(_available_cpus(), OCR_WORKERS, len(page_nums))
+    batch_size = -(-len(page_nums) // workers)
+    batches = [page_nums[start:start + batch_size] for start in range(0, len(page_nums), batch_size)]
+    with ProcessPoolExecutor(max_workers=len(batches), initializer=_init_ocr_worker) as executor:
+        results = executor.map(partial(_ocr_pages, pdf_path, dpi_scale=dpi_scale), batches)
+        return [text for batch in results for text in batch]
+
+
+def _starts_with_date(line, pos=0):
+    """Check for a dd-mm-yyyy date at line[pos]"""
+    date = line[pos:pos + 10]
+    return (len(date) == 10 and date[2] == date[5] == '-'
+            and date[:2].isdecimal() and date[3:5].isdecimal() and date[6:].isdecimal())
+
+
+def _scan_line(line):
+    """Split a statement line into (post_date, value_date, description, amounts) in one pass"""
+    n = len(line)
+    pos = 0
+    post_date = value_date = None
+    
+    if _starts_with_date(line) and n > 10 and line[10].isspace():
+        post_date = value_date = line[:10]
+        pos = 11
+        while pos < n and line[pos].isspace():
+            pos += 1
+        if _starts_with_date(line, pos):
+            value_date = line[pos:pos + 10]
+            pos += 10
+            while pos < n and line[pos].isspace():
+                pos += 1
+    
+    pieces = []
+    amounts = []
+    start = i = pos
+    while i < n:
+        ch = line[i]
+        if ch.isdecimal() or ch == ',':
+            run_start = i
+            while i < n and (line[i].isdecimal() or line[i] == ','):
+                i += 1
+            # A run of digits/commas is an amount only if followed by .dd
+            if i + 2 < n and line[i] == '.' and line[i + 1].isdecimal() and line[i + 2].isdecimal():
+                pieces.append(line[start:run_start])
+                amounts.append(line[run_start:i + 3])
+                i += 3
+                start = i
+        else:
+            i += 1
+    pieces.append(line[start:])
     
-    doc.close()
-    return '\n'.join(all_text)
+    if post_date:
+        desc = pieces[0]
+    else:
+        desc = ''.join(pieces)
+    return post_date, value_date, desc.strip(), amounts
 
 
 def parse_sbi_transactions(text):
@@ -91,24 +354,11 @@ def parse_sbi_transactions(text):
             i += 1
             continue
         
-        # Match date pattern at start of line
-        date_match = re.match(r'^(\d{2}-\d{2}-\d{4})\s+(\d{2}-\d{2}-\d{4})?\s*(.*)', line)
+        post_date, value_date, desc, amounts = _scan_line(line)
         
-        if date_match:
-            post_date = date_match.group(1)
-            value_date = date_match.group(2) or post_date
-            rest = date_match.group(3).strip()
-            
+        if post_date:
             # Collect description and amounts from current and following lines
             description_parts = []
-            amounts = []
-            
-            # Extract amounts from current line
-            current_amounts = re.findall(r'([\d,]+\.\d{2})', rest)
-            amounts.extend(current_amounts)
-            
-            # Get description part (before amounts)
-            desc = re.sub(r'[\d,]+\.\d{2}.*', '', rest).strip()
             if desc:
                 description_parts.append(desc)
             
@@ -118,15 +368,12 @@ def parse_sbi_transactions(text):
                 next_line = lines[j].strip()
                 
                 # Stop if we hit another date or page marker
-                if re.match(r'^\d{2}-\d{2}-\d{4}', next_line) or 'Page no' in next_line or not next_line:
+                if _starts_with_date(next_line) or 'Page no' in next_line or not next_line:
                     break
                 
-                # Extract amounts
-                next_amounts = re.findall(r'([\d,]+\.\d{2})', next_line)
+                _, _, next_desc, next_amounts = _scan_line(next_line)
                 amounts.extend(next_amounts)
                 
-                # Get description (text not looking like amounts)
-                next_desc = re.sub(r'[\d,]+\.\d{2}', '', next_line).strip()
                 # Filter out garbage OCR
                 if next_desc and len(next_desc) > 2 and not next_desc.replace(' ', '').replace(',', '').isdigit():
                     description_parts.append(next_desc)
@@ -136,34 +383,39 @@ def parse_sbi_transactions(text):
             i = j - 1  # Will be incremented at end of loop
             
             # Build final description
-            full_desc = ' '.join(description_parts)
-            full_desc = re.sub(r'\s+', ' ', full_desc).strip()
+            full_desc = ' '.join(' '.join(description_parts).split())
             
             # Clean OCR artifacts but preserve key words
-            full_desc = re.sub(r'[|]', '', full_desc)
+            full_desc = full_desc.replace('|', '')
             
             # Determine transaction type
             desc_upper = full_desc.upper()
-            is_withdrawal = any(kw in desc_upper for kw in 
-                ['WDL', 'WITHDRAWAL', 'TO INTEREST', 'DIRECT DR', 'DEBIT', 'LEVY', 'DR$', 'ATM'])
+            is_withdrawal = WITHDRAWAL_KEYWORDS_RE.search(desc_upper) is not None
             
             # Parse amounts - typically: [transaction_amount, balance] or just [balance]
             debit = 0.0
             credit = 0.0
             balance = ""
             
-            # Remove duplicate amounts
-            unique_amounts = list(dict.fromkeys(amounts))
+            # First and last distinct amounts; OCR often repeats an amount
+            first_amt = last_amt = None
+            seen_amounts = set()
+            for amt in amounts:
+                if amt not in seen_amounts:
+                    seen_amounts.add(amt)
+                    if first_amt is None:
+                        first_amt = amt
+                    last_amt = amt
             
-            if len(unique_amounts) >= 2:
-                trans_amt = float(unique_amounts[0].replace(',', ''))
-                balance = unique_amounts[-1]
+            if len(seen_amounts) >= 2:
+                trans_amt = float(first_amt.replace(',', ''))
+                balance = last_amt
                 if is_withdrawal:
                     debit = trans_amt
                 else:
                     credit = trans_amt
-            elif len(unique_amounts) == 1:
-                balance = unique_amounts[0]
+            elif first_amt is not None:
+                balance = first_amt
             
             # Only add if we have meaningful data
             if full_desc and (debit > 0 or credit > 0):
@@ -186,8 +438,19 @@ def parse_transactions_from_text(text):
     return parse_sbi_transactions(text)
 
 
+def parse_pdf_with_fitz_tables(doc):
+    """Try to extract tables using PyMuPDF's table finder as fallback"""
+    try:
+        dfs = [table.to_pandas() for page in doc for table in page.find_tables().tables]
+        if dfs:
+            return pd.concat(dfs, ignore_index=True)
+    except Exception as e:
+        print(f"PyMuPDF table extraction failed: {e}")
+    return None
+
+
 def parse_pdf_with_tabula(pdf_path):
-    """Try to extract tables using tabula-py as fallback"""
+    """Try to extract tables using tabula-py as last resort (starts a JVM)"""
     try:
         import tabula
         dfs = tabula.read_pdf(pdf_path, pages='all', multiple_tables=True, lattice=True)
@@ -198,34 +461,33 @@ def parse_pdf_with_tabula(pdf_path):
     return None
 
 
-def extract_transactions_from_pdf(pdf_path):
-    """Main PDF extraction function with multiple methods"""
-    doc = fitz.open(pdf_path)
-    
-    # Check if PDF has text layer
-    first_page = doc[0]
-    text = first_page.get_text()
-    
-    transactions = []
+def extract_page_texts(doc):
+    """Get the text of every page, OCRing only pages without a text layer"""
+    page_texts = [page.get_text() for page in doc]
     
-    if text.strip():
-        # Text-based PDF - parse text
-        all_text = ""
-        for page in doc:
-            all_text += page.get_text() + "\n"
-        transactions = parse_transactions_from_text(all_text)
-    else:
-        # Image-based PDF - use OCR
-        print("Using OCR for image-based PDF...")
-        ocr_text = extract_text_from_image_pdf(pdf_path)
-        transactions = parse_transactions_from_text(ocr_text)
+    scanned_pages = [page_num for page_num, text in enumerate(page_texts) if not text.strip()]
+    if scanned_pages:
+        print(f"Using OCR for {len(scanned_pages)} scanned page(s)...")
+        # OCR workers reopen the file by name; a Document can't cross processes
+        for page_num, text in zip(scanned_pages, ocr_pdf_pages(doc.name, scanned_pages)):
+            page_texts[page_num] = text or ''
     
-    doc.close()
+    return page_texts
+
+
+def extract_transactions_from_doc(doc, page_texts):
+    """Main PDF extraction function with multiple methods"""
+    transactions = parse_transactions_from_text('\n'.join(page_texts))
     
-    # If parsing failed, try tabula
+    # If parsing failed, try table extraction
     if not transactions:
+        print("Trying PyMuPDF table extraction...")
+        df = parse_pdf_with_fitz_tables(doc)
+        if df is not None and not df.empty:
+            return df
+        
         print("Trying tabula extraction...")
-        df = parse_pdf_with_tabula(pdf_path)
+        df = parse_pdf_with_tabula(doc.name)
         if df is not None and not df.empty:
             return df
     
@@ -238,20 +500,19 @@ def extract_transactions_from_pdf(pdf_path):
 def extract_transactions_from_excel(file_path):
     """Extract transactions from Excel file"""
     try:
-        # Try reading with pandas
-        xl = pd.ExcelFile(file_path)
-        
-        # Look for transaction data in sheets
-        for sheet_name in xl.sheet_names:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+        # Open the workbook once and parse sheets from it
+        with pd.ExcelFile(file_path) as xl:
+            # Look for transaction data in sheets, reading only the header row
+            for sheet_name in xl.sheet_names:
+                columns = xl.parse(sheet_name, nrows=0).columns
+                
+                # Check if this looks like a transaction sheet
+                cols_lower = [str(c).lower() for c in columns]
+                if any('date' in c or 'debit' in c or 'credit' in c or 'balance' in c for c in cols_lower):
+                    return xl.parse(sheet_name)
             
-            # Check if this looks like a transaction sheet
-            cols_lower = [str(c).lower() for c in df.columns]
-            if any('date' in c or 'debit' in c or 'credit' in c or 'balance' in c for c in cols_lower):
-                return df
-        
-        # If no matching sheet found, return first sheet
-        return pd.read_excel(file_path)
+            # If no matching sheet found, return first sheet
+            return xl.parse(xl.sheet_names[0])
     except Exception as e:
         print(f"Excel reading failed: {e}")
         return pd.DataFrame()
@@ -283,17 +544,11 @@ def normalize_columns(df):
     return df
 
 
-def clean_amount(value):
-    """Clean amount string to float"""
-    if pd.isna(value) or value == '' or value is None:
-        return 0.0
-    if isinstance(value, (int, float)):
-        return float(value)
-    # Remove commas and convert
-    try:
-        return float(str(value).replace(',', '').replace(' ', ''))
-    except:
-        return 0.0
+def clean_amount(values):
+    """Clean an amount column to floats; blanks and junk become 0"""
+    if values.dtype == object:
+        values = values.astype(str).str.replace(',', '', regex=False).str.replace(' ', '', regex=False)
+    return pd.to_numeric(values, errors='coerce').fillna(0.0).astype(float)
 
 
 def categorize_transaction(description, is_withdrawal=False):
@@ -301,84 +556,107 @@ def categorize_transaction(description, is_withdrawal=False):
     if pd.isna(description):
         return 'Other Withdrawal' if is_withdrawal else 'Other Deposit'
     
-    desc = str(description).upper()
-    
-    for category, patterns in CATEGORY_PATTERNS.items():
-        for pattern in patterns:
-            if re.search(pattern, desc, re.IGNORECASE):
+    return _categorize_cached(str(description).upper(), bool(is_withdrawal))
+
+
+@lru_cache(maxsize=4096)
+def _categorize_cached(desc, is_withdrawal):
+    """Categorize an upper-cased description; statements repeat descriptions a lot"""
+    if STDLIB_ONLY_CHARS_RE.search(desc):
+        for category, regex in CATEGORY_REGEXES:
+            if regex.search(desc):
                 return category
+        return 'Other Withdrawal' if is_withdrawal else 'Other Deposit'
     
+    # Literal substrings first: the automaton finds the most specific hit in
+    # one pass, otherwise `in` checks stop at the first category that hits
+    cutoff, best_category = len(CATEGORY_TIERS), None
+    if LITERAL_AUTOMATON is not None:
+        for _, (priority, category) in LITERAL_AUTOMATON.iter(desc):
+            if priority < cutoff:
+                cutoff, best_category = priority, category
+    else:
+        for priority, category, literals in LITERAL_TIERS:
+            if any(literal in desc for literal in literals):
+                cutoff, best_category = priority, category
+                break
+    
+    # Only regexes ranked above the best literal hit can still win
+    if CATEGORY_SET is not None:
+        for index in CATEGORY_SET.Match(desc) or ():
+            priority = CATEGORY_SET_PRIORITIES[index]
+            if priority < cutoff:
+                cutoff, best_category = priority, CATEGORY_TIERS[priority][0]
+    
+    for priority, category, regex in STDLIB_CATEGORY_REGEXES:
+        if priority >= cutoff:
+            break
+        if regex.search(desc):
+            return category
+    
+    if best_category:
+        return best_category
     return 'Other Withdrawal' if is_withdrawal else 'Other Deposit'
 
 
-def determine_transaction_type(row):
-    """Determine if transaction is deposit or withdrawal"""
-    debit = clean_amount(row.get('Debit', 0))
-    credit = clean_amount(row.get('Credit', 0))
-    
-    if credit > 0:
-        return 'Deposit', credit
-    elif debit > 0:
-        return 'Withdrawal', debit
-    else:
-        # Try to infer from description
-        desc = str(row.get('Description', '')).upper()
-        if any(kw in desc for kw in ['WDL', 'WITHDRAWAL', 'DEBIT', 'DR', 'TRANSFER OUT']):
-            return 'Withdrawal', 0
-        else:
-            return 'Deposit', 0
+def infer_withdrawal(descriptions):
+    """Guess withdrawals from description keywords when no amount says otherwise"""
+    return descriptions.astype(str).str.upper().str.contains(INFERRED_WITHDRAWAL_RE)
 
 
 def process_transactions(df):
     """Process and categorize all transactions"""
     df = normalize_columns(df)
     
-    processed = []
-    
-    for idx, row in df.iterrows():
-        # Skip header rows or empty rows
-        if pd.isna(row.get('Description')) and pd.isna(row.get('Date')):
-            continue
-        
-        trans_type, amount = determine_transaction_type(row)
-        is_withdrawal = trans_type == 'Withdrawal'
-        category = categorize_transaction(row.get('Description', ''), is_withdrawal)
-        
-        # Parse date
-        date_val = row.get('Date') or row.get('Post_Date') or row.get('Value_Date')
-        if pd.notna(date_val):
-            try:
-                if isinstance(date_val, str):
-                    for fmt in ['%d-%m-%Y', '%d/%m/%Y', '%Y-%m-%d', '%d-%b-%Y']:
-                        try:
-                            date_val = datetime.strptime(date_val, fmt)
-                            break
-                        except:
-                            continue
-            except:
-                pass
-        
-        processed.append({
-            'Date': date_val,
-            'Description': row.get('Description', ''),
-            'Category': category,
-            'Type': trans_type,
-            'Amount': amount if amount else clean_amount(row.get('Debit', 0)) or clean_amount(row.get('Credit', 0)),
-            'Debit': clean_amount(row.get('Debit', 0)),
-            'Credit': clean_amount(row.get('Credit', 0)),
-            'Balance': row.get('Balance', '')
-        })
-    
-    return pd.DataFrame(processed)
+    def column(df, name, default=None):
+        if name in df:
+            return df[name]
+        return pd.Series([default] * len(df), index=df.index, dtype=object)
+    
+    # Skip header rows or empty rows
+    df = df[column(df, 'Description').notna() | column(df, 'Date').notna()].reset_index(drop=True)
+    
+    debit = clean_amount(column(df, 'Debit', 0))
+    credit = clean_amount(column(df, 'Credit', 0))
+    descriptions = column(df, 'Description', '')
+    
+    # Credits are deposits, debits are withdrawals, otherwise infer from description
+    is_withdrawal = (credit <= 0) & ((debit > 0) | infer_withdrawal(descriptions))
+    amount = credit.where(credit > 0, debit.where(debit != 0, credit))
+    
+    categories = [categorize_transaction(desc, wdl) for desc, wdl in zip(descriptions, is_withdrawal)]
+    # Use the post/value dates where Date is blank, then parse the whole column
+    # in one go; values that don't parse as dates are kept as they were
+    dates = column(df, 'Date')
+    for fallback in ['Post_Date', 'Value_Date']:
+        dates = dates.where(dates.notna() & (dates != ''), column(df, fallback))
+    is_text = dates.map(lambda value: isinstance(value, str))
+    parsed = pd.to_datetime(dates.where(is_text), format='mixed', dayfirst=True, errors='coerce')
+    dates = parsed.astype(object).where(parsed.notna(), dates)
+    
+    processed = pd.DataFrame({
+        'Date': dates,
+        'Description': descriptions,
+        'Category': categories,
+        'Type': np.where(is_withdrawal, 'Withdrawal', 'Deposit'),
+        'Amount': amount,
+        'Debit': debit,
+        'Credit': credit,
+        'Balance': column(df, 'Balance', ''),
+    })
+    
+    return processed
 
 
 def create_styled_workbook(processed_df, account_name='', account_no='', bank_name='SBI'):
     """Create styled Excel workbook with deposits, withdrawals, and summary sheets"""
-    wb = Workbook()
+    # Write-only mode streams rows out instead of keeping every cell in memory
+    wb = Workbook(write_only=True)
     
     # Styles
     header_font = Font(bold=True, color='FFFFFF')
     header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
+    bold_font = Font(bold=True)
     currency_format = '#,##0.00'
     thin_border = Border(
         left=Side(style='thin'),
@@ -387,132 +665,142 @@ def create_styled_workbook(processed_df, account_name='', account_no='', bank_na
         bottom=Side(style='thin')
     )
     
+    # Amount cells share named styles instead of setting number_format cell by cell
+    amount_style = NamedStyle(name='Amount', font=DEFAULT_FONT, number_format=currency_format)
+    amount_total_style = NamedStyle(name='Amount Total', font=bold_font, number_format=currency_format)
+    wb.add_named_style(amount_style)
+    wb.add_named_style(amount_total_style)
+    
+    def styled(ws, value, font=None, fill=None, style=None):
+        """Build a write-only cell with the given styles"""
+        cell = WriteOnlyCell(ws, value=value)
+        if style:
+            cell.style = style.name
+        if font:
+            cell.font = font
+        if fill:
+            cell.fill = fill
+        return cell
+    
+    def write_rows(ws, rows):
+        """Append {row: {column: value}} to a write-only sheet, in row order"""
+        for row_num in range(1, max(rows) + 1):
+            row = rows.get(row_num, {})
+            ws.append([row.get(col) for col in range(1, max(row, default=0) + 1)])
+    
     # Separate deposits and withdrawals
     deposits = processed_df[processed_df['Type'] == 'Deposit'].copy()
     withdrawals = processed_df[processed_df['Type'] == 'Withdrawal'].copy()
     
-    def create_category_sheet(ws, transactions_df, sheet_title):
+    # Per-category totals, shared by the category sheets and the summary
+    deposit_totals = deposits.groupby('Category')['Amount'].sum()
+    withdrawal_totals = withdrawals.groupby('Category')['Amount'].sum()
+    
+    def create_category_sheet(ws, transactions_df, category_totals, sheet_title):
         """Create a sheet with transactions grouped by category"""
         # Header info
-        ws['A1'] = 'Name'
-        ws['B1'] = account_name
-        ws['A2'] = 'Bank'
-        ws['B2'] = bank_name
-        ws['A3'] = 'Account NO'
-        ws['B3'] = account_no
+        rows = defaultdict(dict)
+        rows[1].update({1: 'Name', 2: account_name})
+        rows[2].update({1: 'Bank', 2: bank_name})
+        rows[3].update({1: 'Account NO', 2: account_no})
         
         # Group by category
         categories = transactions_df.groupby('Category')
         
-        col_offset = 2  # Start from column C (index 3)
+        col_offset = 2  # Start from column B
         
+        # Categories sit side by side, so lay them out before writing any row
         for category, group in categories:
             # Category header
-            ws.cell(row=4, column=col_offset, value=category).font = Font(bold=True)
+            rows[4][col_offset] = styled(ws, category, font=bold_font)
             
             # Column headers
-            ws.cell(row=5, column=col_offset, value='Date').font = header_font
-            ws.cell(row=5, column=col_offset).fill = header_fill
-            ws.cell(row=5, column=col_offset + 1, value='Amount').font = header_font
-            ws.cell(row=5, column=col_offset + 1).fill = header_fill
+            rows[5][col_offset] = styled(ws, 'Date', font=header_font, fill=header_fill)
+            rows[5][col_offset + 1] = styled(ws, 'Amount', font=header_font, fill=header_fill)
             
             # Data
             row_num = 6
-            total = 0
-            for _, trans in group.iterrows():
-                ws.cell(row=row_num, column=col_offset, value=trans['Date'])
-                ws.cell(row=row_num, column=col_offset + 1, value=trans['Amount'])
-                ws.cell(row=row_num, column=col_offset + 1).number_format = currency_format
-                total += trans['Amount']
+            for date, amount in group[['Date', 'Amount']].itertuples(index=False, name=None):
+                rows[row_num][col_offset] = date
+                rows[row_num][col_offset + 1] = styled(ws, amount, style=amount_style)
                 row_num += 1
             
             # Total row
-            ws.cell(row=row_num, column=col_offset, value='Total').font = Font(bold=True)
-            ws.cell(row=row_num, column=col_offset + 1, value=total).font = Font(bold=True)
-            ws.cell(row=row_num, column=col_offset + 1).number_format = currency_format
+            rows[row_num][col_offset] = styled(ws, 'Total', font=bold_font)
+            rows[row_num][col_offset + 1] = styled(ws, category_totals[category], style=amount_total_style)
             
             col_offset += 3  # Move to next category column group
         
-        # Adjust column widths
+        # Adjust column widths (write-only sheets need them before the first row)
         for col in range(1, col_offset + 1):
-            ws.column_dimensions[chr(64 + col) if col <= 26 else f'A{chr(64 + col - 26)}'[0]].width = 15
+            ws.column_dimensions[get_column_letter(col)].width = 15
+        
+        write_rows(ws, rows)
     
     # Create Deposits sheet
-    ws_deposits = wb.active
-    ws_deposits.title = 'Deposits'
-    create_category_sheet(ws_deposits, deposits, 'Deposits')
+    ws_deposits = wb.create_sheet('Deposits')
+    create_category_sheet(ws_deposits, deposits, deposit_totals, 'Deposits')
     
     # Create Withdrawals sheet
     ws_withdrawals = wb.create_sheet('withdrawals')
-    create_category_sheet(ws_withdrawals, withdrawals, 'Withdrawals')
+    create_category_sheet(ws_withdrawals, withdrawals, withdrawal_totals, 'Withdrawals')
     
     # Create Summary sheet
     ws_summary = wb.create_sheet('summary')
-    ws_summary['A1'] = 'Name'
-    ws_summary['B1'] = account_name
-    ws_summary['A2'] = 'Bank'
-    ws_summary['B2'] = bank_name
-    ws_summary['A3'] = 'Account NO'
-    ws_summary['B3'] = account_no
-    
-    # Summary headers
-    ws_summary['D4'] = 'SL No'
-    ws_summary['E4'] = 'Particulars'
-    ws_summary['F4'] = 'Deposits'
-    ws_summary['G4'] = 'Withdrwals'
-    
-    for cell in ['D4', 'E4', 'F4', 'G4']:
-        ws_summary[cell].font = header_font
-        ws_summary[cell].fill = header_fill
+    
+    # Adjust column widths
+    ws_summary.column_dimensions['D'].width = 8
+    ws_summary.column_dimensions['E'].width = 35
+    ws_summary.column_dimensions['F'].width = 15
+    ws_summary.column_dimensions['G'].width = 15
+    
+    summary_rows = defaultdict(dict)
+    summary_rows[1].update({1: 'Name', 2: account_name})
+    summary_rows[2].update({1: 'Bank', 2: bank_name})
+    summary_rows[3].update({1: 'Account NO', 2: account_no})
+    
+    # Summary headers (columns D-G)
+    for col, title in enumerate(['SL No', 'Particulars', 'Deposits', 'Withdrwals'], start=4):
+        summary_rows[4][col] = styled(ws_summary, title, font=header_font, fill=header_fill)
     
     # Calculate opening balance (if available)
     row_num = 5
     sl_no = 1
     
     # Opening balance row
-    ws_summary[f'D{row_num}'] = sl_no
-    ws_summary[f'E{row_num}'] = 'Opening Balance'
-    ws_summary[f'F{row_num}'] = ''
-    ws_summary[f'G{row_num}'] = ''
+    summary_rows[row_num].update({4: sl_no, 5: 'Opening Balance', 6: '', 7: ''})
     row_num += 1
     sl_no += 1
     
     # Deposit categories
-    deposit_totals = deposits.groupby('Category')['Amount'].sum()
     for category, total in deposit_totals.items():
-        ws_summary[f'D{row_num}'] = sl_no
-        ws_summary[f'E{row_num}'] = category
-        ws_summary[f'F{row_num}'] = total
-        ws_summary[f'F{row_num}'].number_format = currency_format
+        summary_rows[row_num].update({
+            4: sl_no,
+            5: category,
+            6: styled(ws_summary, total, style=amount_style),
+        })
         row_num += 1
         sl_no += 1
     
     # Withdrawal categories
-    withdrawal_totals = withdrawals.groupby('Category')['Amount'].sum()
     for category, total in withdrawal_totals.items():
-        ws_summary[f'D{row_num}'] = sl_no
-        ws_summary[f'E{row_num}'] = category
-        ws_summary[f'G{row_num}'] = total
-        ws_summary[f'G{row_num}'].number_format = currency_format
+        summary_rows[row_num].update({
+            4: sl_no,
+            5: category,
+            7: styled(ws_summary, total, style=amount_style),
+        })
         row_num += 1
         sl_no += 1
     
     # Totals
     row_num += 1
-    ws_summary[f'E{row_num}'] = 'Total'
-    ws_summary[f'E{row_num}'].font = Font(bold=True)
-    ws_summary[f'F{row_num}'] = deposits['Amount'].sum()
-    ws_summary[f'F{row_num}'].number_format = currency_format
-    ws_summary[f'F{row_num}'].font = Font(bold=True)
-    ws_summary[f'G{row_num}'] = withdrawals['Amount'].sum()
-    ws_summary[f'G{row_num}'].number_format = currency_format
-    ws_summary[f'G{row_num}'].font = Font(bold=True)
+    summary_rows[row_num].update({
+        5: styled(ws_summary, 'Total', font=bold_font),
+        6: styled(ws_summary, deposits['Amount'].sum(), style=amount_total_style),
+        7: styled(ws_summary, withdrawals['Amount'].sum(), style=amount_total_style),
+    })
     
-    # Adjust column widths
-    ws_summary.column_dimensions['D'].width = 8
-    ws_summary.column_dimensions['E'].width = 35
-    ws_summary.column_dimensions['F'].width = 15
-    ws_summary.column_dimensions['G'].width = 15
+    write_rows(ws_summary, summary_rows)
     
     return wb
 
@@ -523,12 +811,12 @@ def extract_account_info_from_text(text):
     account_name = ''
     
     # Account number patterns
-    acc_match = re.search(r'Account\s*(?:No|Number)[:\s]+(\d+)', text, re.IGNORECASE)
+    acc_match = ACCOUNT_NO_RE.search(text)
     if acc_match:
         account_no = acc_match.group(1)
     
     # Name patterns
-    name_match = re.search(r'(?:Mr\.|Mrs\.|Ms\.?)\s*([A-Z\s]+?)(?:\n|#|Address)', text, re.IGNORECASE)
+    name_match = ACCOUNT_NAME_RE.search(text)
     if name_match:
         account_name = name_match.group(1).strip()
     
@@ -561,11 +849,12 @@ def upload_file():
         ext = filename.rsplit('.', 1)[1].lower()
         
         if ext == 'pdf':
-            df = extract_transactions_from_pdf(filepath)
-            # Try to extract account info
+            # Open the PDF once for text, OCR, tables and account info
             with fitz.open(filepath) as doc:
-                text = doc[0].get_text() if doc[0].get_text() else extract_text_from_image_pdf(filepath)
-                account_name, account_no = extract_account_info_from_text(text)
+                page_texts = extract_page_texts(doc)
+                df = extract_transactions_from_doc(doc, page_texts)
+                # Try to extract account info from the first page
+                account_name, account_no = extract_account_info_from_text(page_texts[0] if page_texts else '')
         elif ext in ['xls', 'xlsx']:
             df = extract_transactions_from_excel(filepath)
             account_name, account_no = '', ''